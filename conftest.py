@@ -0,0 +1,2 @@
+# Lets pytest put the repository root on sys.path, so the tests can import
+# src.experimentation without installing the package
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.experimentation.data_processors import (
+    ABDataProcessor,
+    DFABTestProcessor,
+    ExperimentSummaryStats,
+)
+
+
+@pytest.fixture
+def summary_df() -> pd.DataFrame:
+    """
+    Aggregated experiment data joined to control, as fed to DFABTestProcessor
+    """
+    rng = np.random.default_rng(0)
+    n = 3000
+    experiment_df = pd.DataFrame(
+        {
+            "VARIANT_NAME": rng.choice(["control", "a", "b"], n),
+            "NUM_GAME_START": rng.poisson(5, n).astype(float),
+            "TOTAL_REVENUE": rng.exponential(2.0, n),
+        }
+    )
+    experiment_df["VARIANT_DEFAULT"] = (
+        experiment_df["VARIANT_NAME"] == "control"
+    ).astype(int)
+
+    return ExperimentSummaryStats(
+        experiment_df, ["NUM_GAME_START", "TOTAL_REVENUE"]
+    ).transform()
+
+
+@pytest.fixture
+def experiment_df() -> pd.DataFrame:
+    """
+    Small experiment with hand-checkable statistics: variant a clearly beats
+    control on CLICKS, nothing else is significant
+    """
+    return pd.DataFrame(
+        {
+            "VARIANT_NAME": ["control"] * 4 + ["b"] * 4 + ["a"] * 4,
+            "VARIANT_DEFAULT": [1] * 4 + [0] * 8,
+            "CLICKS": [10.0, 11, 9, 10, 6, 5, 7, 6, 14, 15, 13, 14],
+            "REVENUE": [2.0, 4, 6, 8, 3, 5, 7, 9, 1, 3, 5, 7],
+        }
+    )
+
+
+def test_pipeline_matches_baseline(experiment_df):
+    original_df = experiment_df.copy()
+
+    summary_df = ExperimentSummaryStats(
+        experiment_df, ["CLICKS", "REVENUE"]
+    ).transform()
+
+    assert list(summary_df.columns) == [
+        "VARIANT_NAME",
+        "VARIANT_DEFAULT",
+        "KPI",
+        "count_EXP",
+        "mean_EXP",
+        "var_EXP",
+        "mean_CONTROL",
+        "var_CONTROL",
+        "count_CONTROL",
+    ]
+    assert list(zip(summary_df["VARIANT_NAME"], summary_df["KPI"])) == [
+        ("a", "CLICKS"),
+        ("a", "REVENUE"),
+        ("b", "CLICKS"),
+        ("b", "REVENUE"),
+    ]
+    assert summary_df["mean_EXP"].tolist() == [14.0, 4.0, 6.0, 6.0]
+    assert summary_df["mean_CONTROL"].tolist() == [10.0, 5.0, 10.0, 5.0]
+
+    processed_df = DFABTestProcessor(summary_df).process_df()
+    original_processed_df = processed_df.copy()
+    result = ABDataProcessor(processed_df).process_data()
+
+    assert result["COLOR"].tolist() == ["#77DD77", "#CFCFC4", "#CFCFC4", "#CFCFC4"]
+    assert result["P_VALUE"].to_numpy() == pytest.approx(
+        [2.1310730958e-12, 0.70805878961, 1.0, 0.29194121039]
+    )
+    assert result["UPPER_CI"].to_numpy() == pytest.approx(
+        [4.9496566843, 2.0030781176, -3.0503433157, 4.0030781176]
+    )
+    assert result["LOWER_CI"].to_numpy() == pytest.approx(
+        [3.0503433157, -4.0030781176, -4.9496566843, -2.0030781176]
+    )
+    assert result["UPLIFT_UPPER_CI"].tolist() == [0.495, 0.4006, -0.305, 0.8006]
+    assert result["UPLIFT_LOWER_CI"].tolist() == [0.305, -0.8006, -0.495, -0.4006]
+
+    # Each step adds its columns to a new dataframe
+    pd.testing.assert_frame_equal(experiment_df, original_df)
+    pd.testing.assert_frame_equal(processed_df, original_processed_df)
+
+
+def test_color_statistically_significant():
+    df = pd.DataFrame(
+        {
+            "Z_SCORE": [2.0, -2.0, 2.0, -2.0],
+            "IS_STATISTICALLY_SIGNIFICANT": [True, True, False, False],
+        }
+    )
+
+    result = ABDataProcessor(df).color_statistically_significant()
+
+    assert result["COLOR"].tolist() == ["#77DD77", "#FF6961", "#CFCFC4", "#CFCFC4"]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"significance_confidence_level": 0.8, "ci_confidence_level": 0.99, "dp": 2},
+    ],
+)
+def test_numba_engine_matches_numpy(summary_df, params):
+    pytest.importorskip("numba")
+
+    processed_df = DFABTestProcessor(summary_df).process_df()
+    expected = ABDataProcessor(processed_df).process_data(**params)
+    result = ABDataProcessor(processed_df).process_data(engine="numba", **params)
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_get_metrics_polars_matches_numpy(summary_df):
+    pl = pytest.importorskip("polars")
+
+    processor = DFABTestProcessor(summary_df)
+    expected = processor.get_metrics(summary_df)
+    result = processor.get_metrics_polars(pl.from_pandas(summary_df).lazy())
+
+    # polars has no index or column axis name to carry
+    pd.testing.assert_frame_equal(
+        result.collect().to_pandas(), expected, check_names=False
+    )